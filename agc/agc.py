@@ -14,17 +14,24 @@
 """OTU clustering"""
 
 import argparse
+import os
 import sys
 import gzip
-import textwrap
-from pathlib import Path
+import hashlib
+import heapq
+import io
+import pickle
 from collections import Counter
-from typing import Iterator, List
-import nwalign3 as nw
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from dataclasses import dataclass
+from functools import partial
+from itertools import islice
+from pathlib import Path
+from threading import Event
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 import numpy as np
-np.int = int
-# https://github.com/briney/nwalign3
-# ftp://ftp.ncbi.nih.gov/blast/matrices/
+from nw_jit import encode, nw_identity, read_matrix
 
 __author__ = "Anaïs DELASSUS"
 __copyright__ = "Universite Paris Diderot"
@@ -35,6 +42,21 @@ __maintainer__ = "Anaïs DELASSUS"
 __email__ = "anais.delassus@etu.u-paris.fr"
 __status__ = "Developpement"
 
+BUFFER_SIZE = 1 << 20
+# Minimum number of OTUs to compare a candidate to them in parallel
+PARALLEL_MIN_OTU = 32
+# Number of candidates between two sorts of the OTUs by number of hits
+HIT_SORT_INTERVAL = 64
+# Version of the similarity decisions saved in the memo file, to increase
+# whenever the alignment or the identity criterion changes
+MEMO_VERSION = 4
+# Maximum number of decisions kept in the memo file
+MEMO_MAX_SIZE = 1 << 21
+# ftp://ftp.ncbi.nih.gov/blast/matrices/
+MATCH_MATRIX = read_matrix(Path(__file__).parent / "MATCH")
+UPPER_TABLE = bytes.maketrans(b"abcdefghijklmnopqrstuvwxyz",
+                              b"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
 
 def isfile(path: str) -> Path:  # pragma: no cover
     """Check if path is an existing file.
@@ -75,9 +97,26 @@ def get_arguments():  # pragma: no cover
                         help="Minimum count for dereplication  (default 10)")
     parser.add_argument('-o', '-output_file', dest='output_file', type=Path,
                         default=Path("OTU.fasta"), help="Output file")
+    parser.add_argument('-c', '-memo_file', dest='memo_file', type=Path,
+                        default=Path.home() / ".cache" / "agc" / "memo.pkl",
+                        help="File keeping the similarity decisions between \
+                            runs (default ~/.cache/agc/memo.pkl)")
     return parser.parse_args()
 
 
+def get_record_sequence(record: bytes) -> bytes:
+    """Extract the uppercase sequence of a fasta record.
+
+    :param record: (bytes) Fasta record, header line included.
+    :return: (bytes) The sequence without line breaks, in uppercase.
+    """
+    header_end = record.find(b"\n")
+    if header_end < 0:
+        return b""
+    # Line breaks are deleted while uppercasing, in a single copy
+    return record[header_end + 1:].translate(UPPER_TABLE, b"\r\n")
+
+
 def read_fasta(amplicon_file: Path, minseqlen: int) -> Iterator[str]:
     """Read a compressed fasta and extract all fasta sequences.
 
@@ -85,24 +124,23 @@ def read_fasta(amplicon_file: Path, minseqlen: int) -> Iterator[str]:
     :param minseqlen: (int) Minimum amplicon sequence length
     :return: A generator object that provides the Fasta sequences (str).
     """
-    with gzip.open(str(amplicon_file), "rt") as fasta:
-        seq_lines = []
-        for line in fasta:
-            line = line.strip("\n\r")
-            if not line:
-                continue
-            if line.startswith(">"):
-                if seq_lines:
-                    seq = "".join(s.strip() for s in seq_lines).upper()
-                    if len(seq) >= minseqlen:
-                        yield seq
-                    seq_lines = []
-                continue
-            seq_lines.append(line)
-        if seq_lines:
-            seq = "".join(s.strip() for s in seq_lines).upper()
-            if len(seq) >= minseqlen:
-                yield seq
+    with gzip.open(str(amplicon_file), "rb") as compressed:
+        fasta = io.BufferedReader(compressed, buffer_size=BUFFER_SIZE)
+        tail = b""
+        while True:
+            chunk = fasta.read(BUFFER_SIZE)
+            records = (tail + chunk).split(b"\n>")
+            # The last record may continue in the next chunk
+            tail = records.pop()
+            for record in records:
+                body = get_record_sequence(record)
+                if body and len(body) >= minseqlen:
+                    yield body.decode("ascii")
+            if not chunk:
+                break
+        body = get_record_sequence(tail)
+        if body and len(body) >= minseqlen:
+            yield body.decode("ascii")
 
 
 def dereplication_fulllength(amplicon_file: Path, minseqlen: int,
@@ -116,10 +154,17 @@ def dereplication_fulllength(amplicon_file: Path, minseqlen: int,
     sequence with a count >= mincount and a length >= minseqlen.
     """
     counts = Counter(read_fasta(amplicon_file, minseqlen))
-    filtered_sorted = sorted(
-        [[seq, count] for seq, count in counts.items() if count >= mincount],
-        key=lambda x: x[1], reverse=True)
-    yield from filtered_sorted
+    # Max-heap on the count, ties keep the order of first occurrence, the
+    # sequences are only ordered as they are consumed
+    heap = [(-count, rank, seq)
+            for rank, (seq, count) in enumerate(counts.items())
+            if count >= mincount]
+    # The rare sequences are released before the clustering starts
+    del counts
+    heapq.heapify(heap)
+    while heap:
+        count, _, seq = heapq.heappop(heap)
+        yield [seq, -count]
 
 
 def get_identity(alignment_list: List[str]) -> float:
@@ -135,13 +180,275 @@ def get_identity(alignment_list: List[str]) -> float:
     min_l = min(len(a), len(b))
     if min_l == 0:
         return 0.0
-    identical = sum(1 for a, b in zip(a[:min_l], b[:min_l]) if a == b)
+    # Columns are compared as bytes in a single vectorized pass
+    bytes_a = np.frombuffer(a[:min_l].encode("ascii"), dtype=np.uint8)
+    bytes_b = np.frombuffer(b[:min_l].encode("ascii"), dtype=np.uint8)
+    identical = int(np.count_nonzero(bytes_a == bytes_b))
     return (identical / min_l) * 100.0
 
 
+def cut_kmer(sequence: str, kmer_size: int) -> Iterator[str]:
+    """Cut sequence into kmers
+
+    :param sequence: (str) Sequence from which to extract kmers.
+    :param kmer_size: (int) Size of the kmers.
+    :return: A generator object that provides the kmers (str) of size 
+    kmer_size.
+    """
+    for i in range(len(sequence) - kmer_size + 1):
+        yield sequence[i:i + kmer_size]
+
+
+def get_max_edit(min_len: int, identity: float = 97.0) -> int:
+    """Compute the maximum number of edited columns (mismatches and gaps)
+    in an alignment reaching the identity threshold.
+
+    The identity is the number of identical columns over the alignment
+    length, which cannot exceed the length of the shortest sequence.
+
+    :param min_len: (int) Length of the shortest sequence.
+    :param identity: (float) Identity threshold (%).
+    :return: (int) Maximum number of edited columns.
+    """
+    return int(min_len * (100.0 - identity) / identity + 1e-6)
+
+
+def get_seq_hash(sequence: str) -> int:
+    """Compute a 64 bits hash of a sequence, stable between runs.
+
+    :param sequence: (str) Nucleotide sequence.
+    :return: (int) Hash of the sequence.
+    """
+    return int.from_bytes(hashlib.blake2b(sequence.encode("ascii"),
+                                          digest_size=8).digest(), "little")
+
+
+def load_memo(memo_file: Path) -> Dict[Tuple[int, int], bool]:
+    """Load the similarity decisions saved by a previous run.
+
+    :param memo_file: (Path) Path to the memo file.
+    :return: (dict) Decisions indexed by (query hash, OTU hash), empty if
+    the file is missing, unreadable or from another MEMO_VERSION.
+    """
+    try:
+        with open(str(memo_file), "rb") as memo_in:
+            saved = pickle.load(memo_in)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+            AttributeError, ImportError, IndexError):
+        return {}
+    if not isinstance(saved, dict) or saved.get("version") != MEMO_VERSION:
+        return {}
+    memo = saved.get("memo")
+    return memo if isinstance(memo, dict) else {}
+
+
+def save_memo(memo: Dict[Tuple[int, int], bool], memo_file: Path) -> None:
+    """Save the similarity decisions for the next runs, only the last
+    MEMO_MAX_SIZE decisions recorded are kept. The memo is only a cache, a
+    file that cannot be written is reported on stderr and skipped.
+
+    :param memo: (dict) Decisions indexed by (query hash, OTU hash).
+    :param memo_file: (Path) Path to the memo file.
+    """
+    if len(memo) > MEMO_MAX_SIZE:
+        # Decisions are in insertion order, the oldest ones are dropped
+        memo = dict(islice(memo.items(), len(memo) - MEMO_MAX_SIZE, None))
+    tmp_file = memo_file.with_name(memo_file.name + ".tmp")
+    try:
+        memo_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(tmp_file), "wb") as memo_out:
+            pickle.dump({"version": MEMO_VERSION, "memo": memo}, memo_out,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp_file), str(memo_file))
+    except OSError as error:
+        print(f"Memo not saved in {memo_file}: {error}", file=sys.stderr)
+
+
+@dataclass
+class Amplicon:
+    """Dereplicated sequence with the data reused by each of its comparisons.
+
+    For an OTU, hits counts the candidates found similar to it.
+    """
+    sequence: str
+    count: int
+    kmers: Set[str]
+    code: np.ndarray
+    seq_hash: int
+    hits: int = 0
+
+
+def get_amplicon(sequence: str, count: int, kmer_size: int) -> Amplicon:
+    """Prepare a dereplicated sequence for its comparisons.
+
+    :param sequence: (str) Nucleotide sequence.
+    :param count: (int) Number of occurrences of the sequence.
+    :param kmer_size: (int) Size of the kmers.
+    :return: (Amplicon) The sequence with its kmers, codes and hash.
+    """
+    return Amplicon(sequence, count, set(cut_kmer(sequence, kmer_size)),
+                    encode(sequence), get_seq_hash(sequence))
+
+
+def is_length_compatible(len_1: int, len_2: int) -> bool:
+    """Check if two sequence lengths allow 97% identity, the identity
+    cannot exceed the ratio of the lengths.
+
+    :param len_1: (int) Length of the first sequence.
+    :param len_2: (int) Length of the second sequence.
+    :return: (bool) True if the length ratio is at least 0.97.
+    """
+    return min(len_1, len_2) >= 0.97 * max(len_1, len_2)
+
+
+def is_similar(query: Amplicon, otu: Amplicon, kmer_size: int) -> bool:
+    """Check if two sequences share at least 97% identity.
+
+    The alignment is skipped when the lengths or the number of shared kmers
+    already rule out 97% identity.
+
+    :param query: (Amplicon) Candidate sequence.
+    :param otu: (Amplicon) OTU sequence.
+    :param kmer_size: (int) Size of the kmers of both sequences.
+    :return: (bool) True if the identity is at least 97%.
+    """
+    len_query, len_otu = len(query.sequence), len(otu.sequence)
+    if not is_length_compatible(len_query, len_otu):
+        return False
+    max_edit = get_max_edit(min(len_query, len_otu))
+    min_shared = (max(len(query.kmers), len(otu.kmers))
+                  - kmer_size * max_edit)
+    if len(query.kmers & otu.kmers) < min_shared:
+        return False
+    # Every alignment reaching 97% stays within max_edit of the diagonal,
+    # which is used as the band of the DP
+    return nw_identity(query.code, otu.code, MATCH_MATRIX, max_edit) >= 97.0
+
+
+def is_similar_memo(otu: Amplicon, query: Amplicon, kmer_size: int,
+                    memo: Dict[Tuple[int, int], bool]) -> bool:
+    """Check if two sequences share at least 97% identity, reusing and
+    recording the decisions in memo.
+
+    :param otu: (Amplicon) OTU sequence.
+    :param query: (Amplicon) Candidate sequence.
+    :param kmer_size: (int) Size of the kmers of both sequences.
+    :param memo: (dict) Decisions indexed by (query hash, OTU hash).
+    :return: (bool) True if the identity is at least 97%.
+    """
+    # Pairs of incompatible lengths are cheaper to test than to memoize
+    if not is_length_compatible(len(query.sequence), len(otu.sequence)):
+        return False
+    key = (query.seq_hash, otu.seq_hash)
+    similar = memo.get(key)
+    if similar is None:
+        similar = is_similar(query, otu, kmer_size)
+        memo[key] = similar
+    return similar
+
+
+def find_similar(match: Callable, otu_chunk: List[Amplicon],
+                 stop: Optional[Event] = None) -> Optional[Amplicon]:
+    """Find the first OTU of a chunk similar to a candidate.
+
+    :param match: (Callable) Test of the candidate against one OTU.
+    :param otu_chunk: (list) OTUs to compare the candidate to.
+    :param stop: (Event) Set when another chunk already found a similar OTU.
+    :return: (Amplicon) The similar OTU, None if there is none.
+    """
+    for otu in otu_chunk:
+        if stop is not None and stop.is_set():
+            return None
+        if match(otu):
+            if stop is not None:
+                stop.set()
+            return otu
+    return None
+
+
+def find_similar_parallel(executor: ThreadPoolExecutor, match: Callable,
+                          otu_list: List[Amplicon],
+                          nb_chunk: int) -> Optional[Amplicon]:
+    """Find an OTU similar to a candidate, comparing chunks of OTUs in
+    parallel and stopping at the first similar OTU found.
+
+    :param executor: (ThreadPoolExecutor) Pool running the comparisons.
+    :param match: (Callable) Test of the candidate against one OTU.
+    :param otu_list: (list) OTUs to compare the candidate to.
+    :param nb_chunk: (int) Number of chunks of OTUs.
+    :return: (Amplicon) A similar OTU, None if there is none.
+    """
+    stop = Event()
+    pending = {executor.submit(find_similar, match, otu_list[i::nb_chunk],
+                               stop)
+               for i in range(nb_chunk)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        # result() raises the errors of the workers, as on the serial path
+        hit = next((otu for otu in [future.result() for future in done]
+                    if otu is not None), None)
+        if hit is not None:
+            for future in pending:
+                future.cancel()
+            # The running chunks stop at their next OTU, they must be over
+            # before the next candidate is compared
+            wait(pending)
+            for future in pending:
+                if not future.cancelled():
+                    future.result()
+            return hit
+    return None
+
+
+def cluster_amplicons(amplicons: Iterator[List], kmer_size: int,
+                      memo: Dict[Tuple[int, int], bool]) -> List[Amplicon]:
+    """Cluster sequences sorted by decreasing count: a sequence becomes an
+    OTU unless it is similar to an OTU found before.
+
+    :param amplicons: (iterator) [sequence, count] sorted by decreasing count.
+    :param kmer_size: (int) Size of the kmers used to prefilter the OTUs
+    before alignment.
+    :param memo: (dict) Decisions indexed by (query hash, OTU hash).
+    :return: (list) The OTUs in the order they were found.
+    """
+    nb_cpu = os.cpu_count() or 1
+    otu_list = []
+    # Same OTUs sorted by decreasing number of hits, the most frequently
+    # matched OTUs are compared first
+    hit_order = []
+    # Last OTU found similar, consecutive candidates often share it
+    last_hit = None
+    # The thread pool is only used with several CPUs
+    with (ThreadPoolExecutor(max_workers=nb_cpu) if nb_cpu > 1
+          else nullcontext()) as executor:
+        for rank, (seq, cnt) in enumerate(amplicons, 1):
+            if rank % HIT_SORT_INTERVAL == 0:
+                hit_order.sort(key=lambda otu: -otu.hits)
+            query = get_amplicon(seq, cnt, kmer_size)
+            match = partial(is_similar_memo, query=query,
+                            kmer_size=kmer_size, memo=memo)
+            # On a miss, the scan reads the decision for the last hit from
+            # memo
+            if last_hit is not None and match(last_hit):
+                hit = last_hit
+            elif executor is not None and len(otu_list) > PARALLEL_MIN_OTU:
+                hit = find_similar_parallel(executor, match, hit_order,
+                                            nb_cpu)
+            else:
+                hit = find_similar(match, hit_order)
+            if hit is None:
+                otu_list.append(query)
+                hit_order.append(query)
+            else:
+                hit.hits += 1
+                last_hit = hit
+    return otu_list
+
+
 def abundance_greedy_clustering(amplicon_file: Path, minseqlen: int,
                                 mincount: int, chunk_size: int,
-                                kmer_size: int) -> List:
+                                kmer_size: int, *,
+                                memo_file: Optional[Path] = None) -> List:
     """Compute an abundance greedy clustering regarding sequence count and 
     identity.
     Identify OTU sequences.
@@ -150,21 +457,19 @@ def abundance_greedy_clustering(amplicon_file: Path, minseqlen: int,
     :param minseqlen: (int) Minimum amplicon sequence length.
     :param mincount: (int) Minimum amplicon count.
     :param chunk_size: (int) A fournir mais non utilise cette annee
-    :param kmer_size: (int) A fournir mais non utilise cette annee
+    :param kmer_size: (int) Size of the kmers used to prefilter the OTUs
+    before alignment.
+    :param memo_file: (Path) File keeping the similarity decisions between
+    runs, not used if None.
     :return: (list) A list of all the [OTU (str), count (int)] .
     """
-    otu_list = []
-    matrix_path = str(Path(__file__).parent / "MATCH")
-    for seq, cnt in dereplication_fulllength(amplicon_file, minseqlen,
-                                             mincount):
-        def is_similar(otu_seq: str, query_seq=seq) -> bool:
-            aln = nw.global_align(query_seq, otu_seq, gap_open=-1,
-                                  gap_extend=-1, matrix=matrix_path)
-            aln_pair = [aln[0], aln[1]]
-            return get_identity(aln_pair) >= 97.0
-        if not any(is_similar(otu_seq) for otu_seq, _ in otu_list):
-            otu_list.append([seq, cnt])
-    return otu_list
+    memo = load_memo(memo_file) if memo_file is not None else {}
+    otu_list = cluster_amplicons(
+        dereplication_fulllength(amplicon_file, minseqlen, mincount),
+        kmer_size, memo)
+    if memo_file is not None:
+        save_memo(memo, memo_file)
+    return [[otu.sequence, otu.count] for otu in otu_list]
 
 
 def write_OTU(OTU_list: List, output_file: Path) -> None:
@@ -173,10 +478,13 @@ def write_OTU(OTU_list: List, output_file: Path) -> None:
     :param OTU_list: (list) A list of OTU sequences
     :param output_file: (Path) Path to the output file
     """
+    records = []
+    for idx, (seq, count) in enumerate(OTU_list, 1):
+        records.append(f">OTU_{idx} occurrence:{count}\n")
+        # Sequences have no spaces, lines are cut every 80 nucleotides
+        records.extend(seq[i:i + 80] + "\n" for i in range(0, len(seq), 80))
     with open(str(output_file), "w", encoding="utf-8") as out:
-        for idx, (seq, count) in enumerate(OTU_list, 1):
-            out.write(f">OTU_{idx} occurrence:{count}\n")
-            out.write(textwrap.fill(seq, width=80) + "\n")
+        out.write("".join(records))
 
 
 # ==============================================================
@@ -195,7 +503,8 @@ def main():  # pragma: no cover
         minseqlen=args.minseqlen,
         mincount=args.mincount,
         chunk_size=100,
-        kmer_size=8
+        kmer_size=8,
+        memo_file=args.memo_file
     )
     print(f"Nombre d'OTUs : {len(otu_list)}")
     for i, (seq, count) in enumerate(otu_list, start=1):
@@ -1,4 +1,5 @@
-import pandas as pd
+import csv
+import os
 
 # Chemin vers le fichier de sortie VSEARCH
 tsv_file = "resultat.tsv"
@@ -20,10 +21,14 @@ columns = [
     "bit_score"
 ]
 
-# Lire le TSV sans en-têtes
-df = pd.read_csv(tsv_file, sep="\t", header=None, names=columns)
-
-# Sauvegarder avec les en-têtes
-df.to_csv(tsv_out, sep="\t", index=False)
+# Recopier le TSV ligne par ligne apres les en-tetes, dans un fichier
+# temporaire puisque l'entree et la sortie peuvent etre le meme fichier
+with open(tsv_file, newline="", encoding="utf-8") as fi, \
+        open(tsv_out + ".tmp", "w", newline="", encoding="utf-8") as fo:
+    writer = csv.writer(fo, delimiter="\t", lineterminator="\n")
+    writer.writerow(columns)
+    for row in csv.reader(fi, delimiter="\t"):
+        writer.writerow(row)
+os.replace(tsv_out + ".tmp", tsv_out)
 
 print(f"Fichier annoté : {tsv_out}")
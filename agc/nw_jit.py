@@ -0,0 +1,140 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Banded Needleman-Wunsch identity compiled with numba"""
+
+from pathlib import Path
+import numpy as np
+from numba import njit
+
+__author__ = "Anaïs DELASSUS"
+__copyright__ = "Universite Paris Diderot"
+__credits__ = ["Anaïs DELASSUS"]
+__license__ = "GPL"
+__version__ = "1.0.0"
+__maintainer__ = "Anaïs DELASSUS"
+__email__ = "anais.delassus@etu.u-paris.fr"
+__status__ = "Developpement"
+
+# Symbols of the MATCH matrix, nucleotides first
+ALPHABET = "ACGTNRBDQZEHILKMFPSWYVX*"
+# Code of any character missing from ALPHABET, which is scored as the worst
+# substitution of the matrix and never counted as identical
+OTHER = len(ALPHABET)
+# Symbols of ALPHABET are coded by their index, in upper or lower case
+CODE_TABLE = np.full(256, OTHER, dtype=np.int8)
+for code, symbol in enumerate(ALPHABET):
+    CODE_TABLE[ord(symbol)] = code
+    CODE_TABLE[ord(symbol.lower())] = code
+# Score of a gap, as gap_open and gap_extend were -1 with nwalign3
+GAP = -1
+# Score of a cell outside the band, low enough to never be chosen
+OUT_OF_BAND = -(1 << 29)
+
+
+def read_matrix(matrix_file: Path) -> np.ndarray:
+    """Read a substitution matrix in NCBI format.
+
+    :param matrix_file: (Path) Path to the matrix file (e.g. MATCH), which
+    must score every symbol of ALPHABET.
+    :return: (np.ndarray) Square int8 scores indexed by the symbol codes.
+    """
+    with open(str(matrix_file), "r", encoding="utf-8") as matrix:
+        lines = [line.split() for line in matrix
+                 if line.strip() and not line.startswith("#")]
+    columns = lines[0]
+    scores = {row[0]: [int(score) for score in row[1:]] for row in lines[1:]}
+    return np.array([[scores[row][columns.index(col)] for col in ALPHABET]
+                     for row in ALPHABET], dtype=np.int8)
+
+
+def encode(sequence: str) -> np.ndarray:
+    """Encode a nucleotide sequence as an int8 array.
+
+    :param sequence: (str) Nucleotide sequence.
+    :return: (np.ndarray) Codes of the symbols, their index in ALPHABET
+    (A=0, C=1, G=2, T=3, N=4...), OTHER for any other character.
+    """
+    return CODE_TABLE[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def nw_identity(seq_a: np.ndarray, seq_b: np.ndarray, matrix: np.ndarray,
+                band: int) -> float:
+    """Compute the identity of the banded global alignment of two sequences.
+
+    The dynamic programming keeps only two rows of the matrix. The number of
+    identical columns and the length of the best path ending in each cell are
+    carried along the scores, so no traceback is needed. Characters coded
+    OTHER get the lowest score of the matrix and never count as identical.
+
+    :param seq_a: (np.ndarray) First encoded sequence.
+    :param seq_b: (np.ndarray) Second encoded sequence.
+    :param matrix: (np.ndarray) Substitution scores from read_matrix.
+    :param band: (int) Maximum distance of the alignment to the diagonal.
+    :return: (float) The rate of identity between the two sequences.
+    """
+    # The outer loop runs over the longest sequence, so that the rows are
+    # sized on the shortest one
+    if len(seq_b) > len(seq_a):
+        seq_a, seq_b = seq_b, seq_a
+    len_a, len_b = len(seq_a), len(seq_b)
+    if len_a - len_b > band:
+        return 0.0
+    other_score = matrix.min()
+    prev = np.empty(len_b + 2, np.int32)
+    curr = np.empty(len_b + 2, np.int32)
+    prev_id = np.zeros(len_b + 2, np.int32)
+    curr_id = np.zeros(len_b + 2, np.int32)
+    prev_len = np.empty(len_b + 2, np.int32)
+    curr_len = np.empty(len_b + 2, np.int32)
+    for j in range(min(len_b, band) + 1):
+        prev[j] = GAP * j
+        prev_len[j] = j
+    prev[min(len_b, band) + 1] = OUT_OF_BAND
+    for i in range(1, len_a + 1):
+        low = max(1, i - band)
+        high = min(len_b, i + band)
+        if i <= band:
+            curr[0] = GAP * i
+            curr_id[0] = 0
+            curr_len[0] = i
+        else:
+            curr[low - 1] = OUT_OF_BAND
+        for j in range(low, high + 1):
+            code_a, code_b = seq_a[i - 1], seq_b[j - 1]
+            if OTHER in (code_a, code_b):
+                best = prev[j - 1] + other_score
+                best_id = prev_id[j - 1]
+            else:
+                best = prev[j - 1] + matrix[code_a, code_b]
+                best_id = prev_id[j - 1] + (1 if code_a == code_b else 0)
+            best_len = prev_len[j - 1] + 1
+            if prev[j] + GAP > best:
+                best = prev[j] + GAP
+                best_id = prev_id[j]
+                best_len = prev_len[j] + 1
+            if curr[j - 1] + GAP > best:
+                best = curr[j - 1] + GAP
+                best_id = curr_id[j - 1]
+                best_len = curr_len[j - 1] + 1
+            curr[j] = best
+            curr_id[j] = best_id
+            curr_len[j] = best_len
+        curr[high + 1] = OUT_OF_BAND
+        prev, curr = curr, prev
+        prev_id, curr_id = curr_id, prev_id
+        prev_len, curr_len = curr_len, prev_len
+    if prev_len[len_b] == 0:
+        return 0.0
+    return prev_id[len_b] * 100.0 / prev_len[len_b]
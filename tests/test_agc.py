@@ -1,15 +1,31 @@
 """Tests agc"""
 import pytest
 import os
+import gzip
 import hashlib
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pathlib import Path
 from .context import agc
 from .test_fixtures import global_data
 from agc import read_fasta
 from agc import dereplication_fulllength
 from agc import get_identity
+from agc import get_max_edit
+from agc import get_amplicon
+from agc import is_similar
+from agc import find_similar_parallel
 from agc import abundance_greedy_clustering
 from agc import write_OTU
+from agc import load_memo
+from agc import save_memo
+from nw_jit import OTHER
+from nw_jit import encode
+from nw_jit import nw_identity
+from nw_jit import read_matrix
 
 
 def test_read_fasta(global_data):
@@ -28,6 +44,20 @@ def test_read_fasta(global_data):
     global_data.grade += 1
 
 
+@pytest.mark.parametrize("buffer_size", [1, 2, 3, 7, 64])
+def test_read_fasta_buffer(tmp_path, monkeypatch, buffer_size):
+    """Records split across buffers are read as a whole"""
+    amplicon_file = tmp_path / "amplicon.fasta.gz"
+    with gzip.open(amplicon_file, "wb") as fasta:
+        fasta.write(b">seq1 desc\nACGT\nacgt\n>seq2\r\nGG\r\nCC\r\n\n"
+                    b">seq3\n>seq4\nTTTT")
+    test_file = Path(__file__).parent / "test_sequences.fasta.gz"
+    expected = list(read_fasta(test_file, 0))
+    monkeypatch.setattr(agc, "BUFFER_SIZE", buffer_size)
+    assert list(read_fasta(amplicon_file, 0)) == ["ACGTACGT", "GGCC", "TTTT"]
+    assert list(read_fasta(test_file, 0)) == expected
+
+
 def test_dereplication_fulllength(global_data):
     """Test dereplication fulllength"""
     dereplication_reader = dereplication_fulllength(
@@ -69,6 +99,37 @@ def test_get_identity(global_data):
     global_data.grade += 4
 
 
+def test_get_max_edit():
+    """Test the maximum number of edited columns at 97% identity"""
+    # 97 / (97 + 3) is exactly 97%
+    assert get_max_edit(97) == 3
+    assert get_max_edit(96) == 2
+    assert get_max_edit(425) == 13
+    assert get_max_edit(0) == 0
+    # 199 / (199 + 1) is exactly 99.5%
+    assert get_max_edit(199, 99.5) == 1
+    assert get_max_edit(198, 99.5) == 0
+
+
+def test_is_similar():
+    """Test the 97% identity decision between two sequences"""
+    otu = get_amplicon(
+        "TGGGGAATATTGCACAATGGGCGCAAGCCTGATGCAGCCATGCCGCGTGTATGAAGAAGGCCTTCG"
+        "GGTTGTAAAGTACTTTCAGCGGGGAGGAAGGTGTTGTGGTTAATAACCGCAGCAATTGACGTTACC",
+        10, 8)
+    # 1 mismatch over 132 columns
+    close = get_amplicon(otu.sequence[:60] + "T" + otu.sequence[61:], 5, 8)
+    # 6 mismatches over 132 columns
+    far = get_amplicon("".join("T" if i % 20 == 10 else nucleotide
+                               for i, nucleotide in enumerate(otu.sequence)),
+                       5, 8)
+    assert is_similar(otu, otu, 8)
+    assert is_similar(close, otu, 8)
+    assert not is_similar(far, otu, 8)
+    # Too short to reach 97% identity
+    assert not is_similar(get_amplicon(otu.sequence[:120], 5, 8), otu, 8)
+
+
 def test_abundance_greedy_clustering(global_data):
     otu = abundance_greedy_clustering(
         Path(__file__).parent / "test_sequences.fasta.gz", 200, 3, 50, 8
@@ -84,6 +145,44 @@ def test_abundance_greedy_clustering(global_data):
     global_data.grade += 7
 
 
+def test_abundance_greedy_clustering_parallel(monkeypatch):
+    """The OTUs do not depend on the comparisons being run in parallel"""
+    amplicon_file = Path(__file__).parent / "test_sequences.fasta.gz"
+    serial = abundance_greedy_clustering(amplicon_file, 200, 1, 50, 8)
+    nb_parallel = []
+
+    def find_similar_parallel(*args):
+        nb_parallel.append(1)
+        return parallel_search(*args)
+    parallel_search = agc.find_similar_parallel
+    monkeypatch.setattr(agc.os, "cpu_count", lambda: 4)
+    monkeypatch.setattr(agc, "PARALLEL_MIN_OTU", 0)
+    monkeypatch.setattr(agc, "find_similar_parallel", find_similar_parallel)
+    parallel = abundance_greedy_clustering(amplicon_file, 200, 1, 50, 8)
+    assert nb_parallel
+    assert parallel == serial
+
+
+def test_find_similar_parallel_error():
+    """An error in a chunk is raised even when another chunk found a hit"""
+    # Both chunks are running when the hit is found, the error comes after
+    barrier = threading.Barrier(2)
+    hit_found = threading.Event()
+
+    def match(otu):
+        barrier.wait(timeout=5)
+        if otu == "error":
+            hit_found.wait(timeout=5)
+            # Let find_similar_parallel collect the hit first
+            time.sleep(0.2)
+            raise ValueError(otu)
+        hit_found.set()
+        return True
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(ValueError):
+            find_similar_parallel(executor, match, ["hit", "error"], 2)
+
+
 def test_write_OTU(global_data):
     test_file = Path(__file__).parent / "test.fna"
     otu = [("TCAGCGAT", 8), ("TCAGCGAA", 8), ("ACAGCGAT", 8), ("ACAGCGAA", 8)]
@@ -94,3 +193,94 @@ def test_write_OTU(global_data):
             == "0a7caf3d43ba5f0c68bc05cb74782dbb"
         )
     global_data.grade += 1
+
+
+def test_encode():
+    """Test nucleotide encoding"""
+    assert list(encode("ACGTN")) == [0, 1, 2, 3, 4]
+    assert list(encode("acgtn")) == [0, 1, 2, 3, 4]
+    # Ambiguous nucleotides of MATCH have their own code
+    codes = list(encode("RYry"))
+    assert codes[0] != codes[1]
+    assert codes[:2] == codes[2:]
+    assert OTHER not in codes
+    # Characters missing from MATCH
+    assert list(encode("-.")) == [OTHER, OTHER]
+
+
+def test_read_matrix():
+    """Test reading the scores of MATCH"""
+    matrix = read_matrix(Path(__file__).parent.parent / "agc" / "MATCH")
+    assert matrix.shape == (24, 24)
+    # MATCH scores X and * 0 against themselves
+    assert list(matrix.diagonal()) == [1] * 22 + [0, 0]
+    assert (matrix[~np.eye(24, dtype=bool)] == -1).all()
+
+
+def test_nw_identity():
+    """Test banded Needleman-Wunsch identity"""
+    matrix = read_matrix(Path(__file__).parent.parent / "agc" / "MATCH")
+    seq_1 = encode("TGGGGAATATTGCACAATGGGCGCAAGCCTGATGCAG")
+    seq_2 = encode("TGGGGAATAGCACAATGGGCGCAAGCCTCTAGCAG")
+    # 33 identical columns over an alignment of 38 columns
+    assert round(nw_identity(seq_1, seq_2, matrix, 10), 1) == 86.8
+    assert nw_identity(seq_2, seq_1, matrix, 10) == nw_identity(
+        seq_1, seq_2, matrix, 10)
+    assert nw_identity(seq_1, seq_1, matrix, 0) == 100.0
+    # The length difference does not fit in the band
+    assert nw_identity(seq_1, seq_2, matrix, 1) == 0.0
+    # Symbols of MATCH are identical to themselves, as with nwalign3
+    assert nw_identity(encode("ACGRT"), encode("ACGRT"), matrix, 2) == 100.0
+    assert nw_identity(encode("ACGRT"), encode("ACGYT"), matrix, 2) == 80.0
+    # Characters missing from MATCH are never identical
+    assert nw_identity(encode("ACG.T"), encode("ACG.T"), matrix, 2) == 80.0
+
+
+def test_memo_round_trip(tmp_path):
+    """Test saving and loading the similarity decisions"""
+    memo_file = tmp_path / "cache" / "memo.pkl"
+    memo = {(1, 2): True, (1, 3): False}
+    save_memo(memo, memo_file)
+    assert load_memo(memo_file) == memo
+    assert not (tmp_path / "cache" / "memo.pkl.tmp").exists()
+
+
+def test_memo_size(tmp_path, monkeypatch):
+    """Only the last decisions recorded are saved"""
+    monkeypatch.setattr(agc, "MEMO_MAX_SIZE", 2)
+    memo_file = tmp_path / "memo.pkl"
+    save_memo({(1, 2): True, (1, 3): False, (4, 2): True}, memo_file)
+    assert load_memo(memo_file) == {(1, 3): False, (4, 2): True}
+
+
+def test_memo_unwritable(tmp_path, capsys):
+    """A memo file that cannot be written does not stop the clustering"""
+    # The parent of the memo file is a regular file
+    (tmp_path / "cache").write_text("")
+    memo_file = tmp_path / "cache" / "memo.pkl"
+    save_memo({(1, 2): True}, memo_file)
+    assert "Memo not saved" in capsys.readouterr().err
+    otu = abundance_greedy_clustering(
+        Path(__file__).parent / "test_sequences.fasta.gz", 200, 3, 50, 8,
+        memo_file=memo_file)
+    assert len(otu) == 2
+
+
+def test_memo_invalid(tmp_path):
+    """Missing, outdated or corrupt memo files give an empty memo"""
+    memo_file = tmp_path / "memo.pkl"
+    assert load_memo(memo_file) == {}
+    with open(memo_file, "wb") as memo_out:
+        pickle.dump({"version": agc.MEMO_VERSION - 1, "memo": {(1, 2): True}},
+                    memo_out)
+    assert load_memo(memo_file) == {}
+    with open(memo_file, "wb") as memo_out:
+        pickle.dump({"version": agc.MEMO_VERSION}, memo_out)
+    assert load_memo(memo_file) == {}
+    with open(memo_file, "wb") as memo_out:
+        pickle.dump([(1, 2)], memo_out)
+    assert load_memo(memo_file) == {}
+    memo_file.write_bytes(b"not a pickle")
+    assert load_memo(memo_file) == {}
+    memo_file.write_bytes(b"")
+    assert load_memo(memo_file) == {}